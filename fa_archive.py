@@ -18,9 +18,13 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-import contextlib
+import concurrent.futures
 import datetime
 import faapi
+import functools
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
@@ -29,6 +33,13 @@ import requests
 import shutil
 import sqlite3
 import sys
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logging.basicConfig(
     format="%(levelname)s: %(message)s",
@@ -37,21 +48,140 @@ logging.basicConfig(
 
 
 # We're not in a hurry, delay every request by at least 5 seconds so that we
-# don't get banned for blasting FA too fast.
+# don't get banned for blasting FA too fast. The delay is shared between all
+# threads making requests, so making them concurrently doesn't hit FA any
+# harder, it just lets the waiting overlap with the transfers themselves.
 class DelayedFAAPI(faapi.FAAPI):
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    RETRY_ATTEMPTS = 8
+    RETRY_BACKOFF_MIN = 10
+    RETRY_BACKOFF_MAX = 300
+
+    def __init__(self, cookies, cancelled):
+        self._cancelled = cancelled
+        self._delay_lock = threading.Lock()
+        self._file_delay_lock = threading.Lock()
+        self._last_file_get = 0
+        super().__init__(cookies)
+
     @faapi.FAAPI.crawl_delay.getter
     def crawl_delay(self):
         delay = faapi.FAAPI.crawl_delay.fget(self)
         return delay if delay > 5 else 5
 
+    # Same as faapi's delay, except that cancelling interrupts it. Backing off
+    # can push the delay out by minutes, which shouldn't hold up a cancel.
+    def handle_delay(self):
+        with self._delay_lock:
+            self.sleep(self.last_get + self.crawl_delay - time.time())
+            self.last_get = time.time()
+
+    # Submission files come from FA's CDN rather than the site itself, so they
+    # get a delay of their own instead of taking turns with the page requests.
+    # They still wait for the crawl delay between each other.
+    def handle_file_delay(self):
+        with self._file_delay_lock:
+            self.sleep(self._last_file_get + self.crawl_delay - time.time())
+            self._last_file_get = time.time()
+
+    def sleep(self, seconds):
+        if self._cancelled.wait(seconds) if seconds > 0 else self._cancelled.is_set():
+            raise StopArchiving()
+
+    # If FA tells us to slow down, wait for as long as it asks or back off
+    # exponentially if it doesn't say. Server errors and connection problems
+    # are retried the same way, rather than by the session itself, so that
+    # retries don't go around the crawl delay. The wait is pushed into the
+    # shared delay, so every other thread backs off too.
+    def get(self, path, **params):
+        return self._retry(
+            functools.partial(super().get, path, **params), self._push_delay
+        )
+
+    # Files from the CDN get the same retries, but only the worker that got
+    # told to slow down waits. Thumbnails don't have any delay to push, so
+    # there's no shared one to push the wait into.
+    def get_file(self, session, url, handle_delay=None):
+        def request():
+            if handle_delay:
+                handle_delay()
+            return session.get(url, stream=True, timeout=self.timeout)
+
+        return self._retry(request, self.sleep)
+
+    # The last attempt is returned or raised as it is, there's no point in
+    # waiting after it.
+    def _retry(self, request, wait):
+        backoff = DelayedFAAPI.RETRY_BACKOFF_MIN
+        for attempt in range(1, DelayedFAAPI.RETRY_ATTEMPTS + 1):
+            try:
+                response = request()
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if attempt == DelayedFAAPI.RETRY_ATTEMPTS:
+                    raise
+                problem = "error {}".format(err)
+                delay = backoff
+            else:
+                if (
+                    response.status_code not in DelayedFAAPI.RETRY_STATUS_CODES
+                    or attempt == DelayedFAAPI.RETRY_ATTEMPTS
+                ):
+                    return response
+                response.close()
+                problem = "HTTP status {} from {}".format(
+                    response.status_code, response.url
+                )
+                delay = self._get_retry_after(response) or backoff
+            delay = min(delay, DelayedFAAPI.RETRY_BACKOFF_MAX)
+            logging.warning("Got %s, waiting %d seconds", problem, delay)
+            wait(delay)
+            backoff = min(backoff * 2, DelayedFAAPI.RETRY_BACKOFF_MAX)
+
+    def _push_delay(self, delay):
+        with self._delay_lock:
+            self.last_get = max(self.last_get, time.time() + delay - self.crawl_delay)
+
+    @staticmethod
+    def _get_retry_after(response):
+        try:
+            return int(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return None
+
 
 class StopArchiving(Exception):
     pass
 
 
 class FaArchiver:
-    EXTENSION_RE = re.compile(r"(\.[^\./]+)$")
     SUBMISSION_RE = re.compile(r"^([0-9]+)([dft])\.")
+    PART_SUFFIX = ".part"
+    DOWNLOAD_WORKERS = 4
+    DOWNLOAD_CHUNK_SIZE = 1 << 16
+    LOGIN_CHECK_INTERVAL = 24 * 60 * 60
+    OPEN_BATCH_SIZE = 256
+    CLOSE_BATCH_SIZE = 32
+    CLOSE_INTERVAL = 10
+    COPY_WORKERS = 8
+    COMMON_EXTENSIONS = (".jpg", ".png", ".gif", ".jpeg", ".webp")
+    # Compact JSON can be encoded entirely in C, indented JSON can't. Indented
+    # is the default though, since it's nicer to look at. If orjson is
+    # installed, it gets used instead and is fast either way. Datetimes are
+    # passed through to JSON_HANDLERS so the output is the same as json's.
+    COMPACT_JSON = bool(os.environ.get("FA_ARCHIVE_COMPACT_JSON"))
+    JSON_FORMAT = {"separators": (",", ":")} if COMPACT_JSON else {"indent": 2}
+    ORJSON_OPTIONS = (
+        orjson.OPT_SORT_KEYS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | (0 if COMPACT_JSON else orjson.OPT_INDENT_2)
+        if orjson
+        else 0
+    )
+    # Everything not listed here is one of faapi's objects, which turn into
+    # dicts of their public fields.
+    JSON_HANDLERS = {
+        datetime.datetime: lambda obj: obj.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
 
     def __init__(self, artist, base_dir, cookies):
         self._artist = artist
@@ -62,8 +192,9 @@ class FaArchiver:
         self._journals_dir = os.path.join(base_dir, "journals")
         self._db_file = os.path.join(base_dir, "archive.db")
         self._api = None
+        self._thumbnail_session = None
         self._db = None
-        self._cancelled = False
+        self._cancelled = threading.Event()
 
     def archive(self):
         self._check_cancelled()
@@ -71,6 +202,7 @@ class FaArchiver:
         self._connect_api()
         self._create_directories()
         self._init_db()
+        self._check_logged_in()
         self._check_artist()
         self._collect_archive_elements()
         self._download_archive_elements()
@@ -81,39 +213,60 @@ class FaArchiver:
         )
 
     def cancel(self):
-        self._cancelled = True
+        self._cancelled.set()
 
     def _check_cancelled(self):
-        if self._cancelled:
+        if self._cancelled.is_set():
             raise StopArchiving()
 
     def _connect_api(self):
         self._check_cancelled()
         logging.debug("Connecting API")
-        self._api = DelayedFAAPI(self._cookies)
-        self._check_logged_in()
+        self._api = DelayedFAAPI(self._cookies, self._cancelled)
+        self._thumbnail_session = faapi.connection.make_session(
+            self._cookies, requests.Session
+        )
 
+    # Checking the login costs a delayed request, so it's skipped if the same
+    # cookies were fine recently. If they stopped working since, faapi will
+    # complain about it on the first page fetched anyway. Only the name of the
+    # logged in user is needed, so this doesn't use faapi's me(), which would
+    # fetch their whole user page on top of that.
     def _check_logged_in(self):
-        user = self._api.me()
+        self._check_cancelled()
+        cookies_hash = self._hash_cookies()
+        login_time = self._get_state_int("login_time")
+        if (
+            login_time is not None
+            and time.time() - login_time < FaArchiver.LOGIN_CHECK_INTERVAL
+            and self._get_state_string("login_cookies") == cookies_hash
+        ):
+            logging.info(
+                "Logged in as '%s' according to database",
+                self._get_state_string("login_user"),
+            )
+            return
+
+        user = faapi.parse.parse_loggedin_user(self._api.get_parsed("login"))
         if user:
-            logging.info("Logged in as '%s%s'", user.status, user.name)
+            logging.info("Logged in as '%s'", user)
+            with self._db as con:
+                self._set_state(con, "login_user", user)
+                self._set_state(con, "login_cookies", cookies_hash)
+                self._set_state(con, "login_time", int(time.time()))
         else:
             raise RuntimeError("Looks like you're not logged in")
 
+    def _hash_cookies(self):
+        cookies = sorted((cookie.name, cookie.value) for cookie in self._cookies)
+        return hashlib.sha256(json.dumps(cookies).encode("utf-8")).hexdigest()
+
     def _create_directories(self):
         self._check_cancelled()
         logging.debug("Creating directories")
-        self._create_directory(self._base_dir)
-        self._create_directory(self._gallery_dir)
-        self._create_directory(self._scraps_dir)
-        self._create_directory(self._journals_dir)
-
-    def _create_directory(self, directory):
-        try:
-            os.mkdir(directory)
-            logging.debug("Created directory '%s'", directory)
-        except FileExistsError:
-            logging.debug("Directory '%s' already exists", directory)
+        for directory in (self._gallery_dir, self._scraps_dir, self._journals_dir):
+            os.makedirs(directory, exist_ok=True)
+            logging.debug("Ensured directory '%s'", directory)
 
     def _init_db(self):
         self._check_cancelled()
@@ -138,6 +291,12 @@ class FaArchiver:
                     unique (type, element_id))
                 """
             )
+            con.execute(
+                """
+                create index if not exists archive_element_open
+                on archive_element(id) where archived = 0
+                """
+            )
 
     def _check_artist(self):
         self._check_cancelled()
@@ -167,15 +326,15 @@ class FaArchiver:
     def _collect_archive_elements(self):
         self._check_cancelled()
         self._collect_archive_element_type(
-            "gallery", self._get_gallery_page, self._insert_submission_element
+            "gallery", self._get_gallery_page, self._submission_element_rows
         )
         self._check_cancelled()
         self._collect_archive_element_type(
-            "scraps", self._get_scraps_page, self._insert_submission_element
+            "scraps", self._get_scraps_page, self._submission_element_rows
         )
         self._check_cancelled()
         self._collect_archive_element_type(
-            "journals", self._get_journals_page, self._insert_journal_element
+            "journals", self._get_journals_page, self._journal_element_rows
         )
 
     def _get_gallery_page(self, page):
@@ -190,39 +349,62 @@ class FaArchiver:
         logging.debug("Get journals page %d", page)
         return self._api.journals(self._artist, page)
 
-    def _insert_submission_element(self, con, element_type, result):
-        self._insert_archive_element(con, element_type, result.id, None)
+    def _submission_element_rows(self, element_type, result):
+        rows = [(element_type, result.id, None)]
         if result.thumbnail_url:
-            self._insert_archive_element(
-                con, element_type + "_thumb", result.id, result.thumbnail_url
-            )
-
-    def _insert_journal_element(self, con, element_type, result):
-        self._insert_archive_element(con, element_type, result.id, None)
-
-    def _collect_archive_element_type(self, element_type, get_page_fn, insert_fn):
+            rows.append((element_type + "_thumb", result.id, result.thumbnail_url))
+        return rows
+
+    def _journal_element_rows(self, element_type, result):
+        return [(element_type, result.id, None)]
+
+    # Once a type has been fully collected, later runs only look for new stuff.
+    # FA lists the newest things first, so that's done as soon as a page turns
+    # up that only contains things we already know about. Every page gets
+    # committed right away, so an interrupted collection doesn't lose what it
+    # already found. It only counts as collected once the last page is done.
+    def _collect_archive_element_type(self, element_type, get_page_fn, rows_fn):
         state_key = "collected_{}".format(element_type)
         if self._get_state_bool(state_key):
-            logging.debug("Already collected %s", element_type)
+            logging.info("Checking for new %s", element_type)
+            known_ids = self._get_archive_element_ids(element_type)
+            # If this check gets interrupted, the pages committed so far would
+            # look like nothing's new next time, hiding anything after them.
+            # So it counts as uncollected until the check is done.
+            with self._db as con:
+                self._set_state(con, state_key, 0)
         else:
             logging.info("Collecting %s", element_type)
-            results = self._get_all_pages(get_page_fn)
+            known_ids = None
+        for page_results in self._iter_all_pages(get_page_fn, known_ids):
+            rows = [
+                row for result in page_results for row in rows_fn(element_type, result)
+            ]
             with self._db as con:
-                for result in results:
-                    insert_fn(con, element_type, result)
-                self._set_state(con, state_key, 1)
+                self._insert_archive_elements(con, rows)
+        with self._db as con:
+            self._set_state(con, state_key, 1)
 
-    def _get_all_pages(self, get_page_fn):
+    # Pages are walked one after another, since each one tells us if there's
+    # another one after it. Fetching ahead wouldn't make this any faster, the
+    # crawl delay is what's limiting us here.
+    def _iter_all_pages(self, get_page_fn, known_ids=None):
         page = 1
-        all_results = []
+        total = 0
         while True:
             self._check_cancelled()
             page_results, next_page = get_page_fn(page)
             logging.debug("%d results on page %d", len(page_results), page)
-            all_results += page_results
+            total += len(page_results)
+            yield page_results
             if next_page is None:
-                logging.debug("%d results total", len(all_results))
-                return all_results
+                logging.debug("%d results total", total)
+                return
+            elif known_ids is not None and all(
+                result.id in known_ids for result in page_results
+            ):
+                logging.debug("Nothing new on page %d, stopping", page)
+                return
             elif next_page > page:
                 page = next_page
             else:
@@ -230,46 +412,155 @@ class FaArchiver:
                     "Next page {} <= current page {}".format(next_page, page)
                 )
 
-    # The actual downloading of stuff to archive.
+    # The actual downloading of stuff to archive. Downloads run on a few worker
+    # threads so that transfers and disk writes can overlap with the crawl
+    # delay, all requests still go through the same delay though. Only this
+    # thread touches the database, it marks finished elements as archived in
+    # batches so that it doesn't need a commit for every single one.
 
     def _download_archive_elements(self):
-        while element := self._get_next_open_archive_element():
-            self._check_cancelled()
-            db_id, element_type, element_id, element_data = element
-            if element_type == "gallery":
-                logging.info("Downloading gallery submission %d", element_id)
-                self._download_submission(element_id, self._gallery_dir)
-            elif element_type == "gallery_thumb":
-                logging.info("Downloading gallery thumbnail %d", element_id)
-                self._download_thumbnail(element_id, element_data, self._gallery_dir)
-            elif element_type == "scraps":
-                logging.info("Downloading scraps submission %d", element_id)
-                self._download_submission(element_id, self._scraps_dir)
-            elif element_type == "scraps_thumb":
-                logging.info("Downloading scraps thumbnail %d", element_id)
-                self._download_thumbnail(element_id, element_data, self._scraps_dir)
-            elif element_type == "journals":
-                logging.info("Downloading journal %d", element_id)
-                self._download_journal(element_id, self._journals_dir)
+        workers = FaArchiver.DOWNLOAD_WORKERS
+        finished = []
+        last_close_time = time.monotonic()
+        downloaded = {
+            "gallery": self._get_downloaded_files(self._gallery_dir),
+            "scraps": self._get_downloaded_files(self._scraps_dir),
+            "journals": self._get_downloaded_files(self._journals_dir),
+        }
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            downloads = set()
+            try:
+                for element in self._iter_open_archive_elements():
+                    self._check_cancelled()
+                    if (
+                        len(finished) >= FaArchiver.CLOSE_BATCH_SIZE
+                        or time.monotonic() - last_close_time
+                        >= FaArchiver.CLOSE_INTERVAL
+                    ):
+                        self._close_archive_elements(finished)
+                        finished.clear()
+                        last_close_time = time.monotonic()
+
+                    db_id, element_type, element_id, _ = element
+                    if self._is_downloaded(downloaded, element_type, element_id):
+                        logging.debug(
+                            "Already downloaded %s %d", element_type, element_id
+                        )
+                        finished.append(db_id)
+                    else:
+                        if len(downloads) >= workers:
+                            self._finish_downloads(
+                                downloads, concurrent.futures.FIRST_COMPLETED, finished
+                            )
+                        downloads.add(
+                            pool.submit(self._download_archive_element, *element)
+                        )
+            except BaseException:
+                # Already on the way out because of an error or a cancel. Make
+                # the other workers stop waiting for their delays too, and
+                # don't let downloads failing in the meantime replace that.
+                self._cancelled.set()
+                self._finish_downloads(
+                    downloads, concurrent.futures.ALL_COMPLETED, finished, False
+                )
+                raise
             else:
-                raise ValueError("Unknown element type '%s'".format(element_type))
-            self._close_archive_element(db_id)
+                self._finish_downloads(
+                    downloads, concurrent.futures.ALL_COMPLETED, finished
+                )
+            finally:
+                self._close_archive_elements(finished)
+
+    # Takes the finished downloads out of the set, so that none of them get
+    # handled twice. Failures are raised after all successful ones have been
+    # put into the finished list, or just logged if raise_errors is False.
+    def _finish_downloads(self, downloads, return_when, finished, raise_errors=True):
+        done, _ = concurrent.futures.wait(downloads, return_when=return_when)
+        downloads.difference_update(done)
+        error = None
+        for future in done:
+            exception = future.exception()
+            if exception is None:
+                finished.append(future.result())
+            elif raise_errors and error is None:
+                error = exception
+            elif not isinstance(exception, StopArchiving):
+                logging.error("Download failed: %s", exception)
+        if error is not None:
+            raise error
+
+    # If an earlier run got killed after downloading something, but before it
+    # could mark it as archived, the files are already there. Files only get
+    # their final name once they're complete, so those can just be skipped.
+    # Older versions wrote to the final name directly though, so empty files
+    # left behind by those get downloaded again.
+    @staticmethod
+    def _get_downloaded_files(directory):
+        with os.scandir(directory) as entries:
+            return {
+                (int(match[1]), match[2])
+                for entry in entries
+                if not entry.name.endswith(FaArchiver.PART_SUFFIX)
+                and (match := FaArchiver.SUBMISSION_RE.match(entry.name))
+                and entry.stat().st_size > 0
+            }
+
+    @staticmethod
+    def _is_downloaded(downloaded, element_type, element_id):
+        location, _, thumb = element_type.partition("_")
+        files = downloaded.get(location)
+        if files is None:
+            return False
+        elif thumb:
+            return (element_id, "t") in files
+        elif location == "journals":
+            return (element_id, "d") in files
+        else:
+            return (element_id, "d") in files and (element_id, "f") in files
+
+    def _download_archive_element(self, db_id, element_type, element_id, element_data):
+        if element_type == "gallery":
+            logging.info("Downloading gallery submission %d", element_id)
+            self._download_submission(element_id, self._gallery_dir)
+        elif element_type == "gallery_thumb":
+            logging.info("Downloading gallery thumbnail %d", element_id)
+            self._download_thumbnail(element_id, element_data, self._gallery_dir)
+        elif element_type == "scraps":
+            logging.info("Downloading scraps submission %d", element_id)
+            self._download_submission(element_id, self._scraps_dir)
+        elif element_type == "scraps_thumb":
+            logging.info("Downloading scraps thumbnail %d", element_id)
+            self._download_thumbnail(element_id, element_data, self._scraps_dir)
+        elif element_type == "journals":
+            logging.info("Downloading journal %d", element_id)
+            self._download_journal(element_id, self._journals_dir)
+        else:
+            raise ValueError("Unknown element type '{}'".format(element_type))
+        return db_id
 
     def _download_submission(self, submission_id, directory):
-        info, data = self._api.submission(submission_id, get_file=True)
+        info, _ = self._api.submission(submission_id)
         ext = self._extract_file_extension(info.file_url)
         self._spew_json(info, os.path.join(directory, "{}d.json".format(submission_id)))
-        self._spew_bytes(
-            data, os.path.join(directory, "{}f{}".format(submission_id, ext))
-        )
+        with self._api.get_file(
+            self._api.session, info.file_url, self._api.handle_file_delay
+        ) as response:
+            response.raise_for_status()
+            self._spew_response(
+                response, os.path.join(directory, "{}f{}".format(submission_id, ext))
+            )
 
+    # Thumbnails are static files from FA's CDN rather than pages of the site
+    # itself, so they don't wait for the crawl delay and get their own session
+    # to keep connections to the CDN alive. The worker pool limits how many of
+    # them are in flight at once.
     def _download_thumbnail(self, submission_id, thumbnail_url, directory):
-        self._api.handle_delay()
-        data = self._api.session.get(thumbnail_url, timeout=self._api.timeout).content
         ext = self._extract_file_extension(thumbnail_url)
-        self._spew_bytes(
-            data, os.path.join(directory, "{}t{}".format(submission_id, ext))
-        )
+        with self._api.get_file(self._thumbnail_session, thumbnail_url) as response:
+            response.raise_for_status()
+            self._spew_response(
+                response, os.path.join(directory, "{}t{}".format(submission_id, ext))
+            )
 
     def _download_journal(self, journal_id, directory):
         info = self._api.journal(journal_id)
@@ -277,9 +568,12 @@ class FaArchiver:
 
     @staticmethod
     def _extract_file_extension(url):
-        match = FaArchiver.EXTENSION_RE.search(url)
-        if match:
-            return match[1]
+        if url.endswith(FaArchiver.COMMON_EXTENSIONS):
+            return url[url.rfind(".") :]
+        name = url.rpartition("/")[2]
+        index = name.rfind(".")
+        if index != -1 and index < len(name) - 1:
+            return name[index:]
         else:
             logging.warning("Unknown file extension in %s", url)
             return ""
@@ -287,21 +581,66 @@ class FaArchiver:
     @staticmethod
     def _spew_json(info, path):
         logging.debug("Writing %s", path)
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(info, f, default=FaArchiver._to_json, sort_keys=True, indent=2)
+        data = FaArchiver._dump_json(info)
+        FaArchiver._write_part_file(path, lambda f: f.write(data))
 
     @staticmethod
-    def _to_json(obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.strftime("%Y-%m-%dT%H:%M:%S")
+    def _dump_json(info):
+        if orjson:
+            return orjson.dumps(
+                info,
+                default=FaArchiver._to_json,
+                option=FaArchiver.ORJSON_OPTIONS,
+            )
         else:
-            return dict(obj)
+            return json.dumps(
+                info,
+                default=FaArchiver._to_json,
+                sort_keys=True,
+                ensure_ascii=False,
+                **FaArchiver.JSON_FORMAT,
+            ).encode("utf-8")
+
+    @staticmethod
+    def _to_json(obj):
+        return FaArchiver.JSON_HANDLERS.get(type(obj), dict)(obj)
 
     @staticmethod
-    def _spew_bytes(data, path):
+    def _spew_response(response, path):
         logging.debug("Writing %s", path)
-        with open(path, "wb") as f:
-            f.write(data)
+
+        def write(f):
+            size = 0
+            for chunk in response.iter_content(FaArchiver.DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                size += len(chunk)
+            expected_size = int(response.headers.get("Content-Length", 0))
+            if expected_size > 0 and expected_size != size:
+                raise RuntimeError(
+                    "Incomplete download of {}, got {} of {} bytes".format(
+                        response.url, size, expected_size
+                    )
+                )
+
+        FaArchiver._write_part_file(path, write)
+
+    # Write into a partial file first and only move it into place once it's
+    # complete, so that an interrupted download never looks finished. If the
+    # writing fails, the partial file is removed again. Ones left over from the
+    # process getting killed are just ignored.
+    @staticmethod
+    def _write_part_file(path, write_fn):
+        part_path = path + FaArchiver.PART_SUFFIX
+        try:
+            with open(part_path, "wb") as f:
+                write_fn(f)
+            os.replace(part_path, path)
+        except BaseException:
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+            raise
 
     # Chunking
 
@@ -337,48 +676,54 @@ class FaArchiver:
         )
 
     def _gather_to_chunk(self):
-        submissions = []
-        submissions += self._gather_to_chunk_from(self._gallery_dir, "gallery")
-        submissions += self._gather_to_chunk_from(self._scraps_dir, "scraps")
-        return sorted(submissions, key=lambda submission: submission["id"])
+        return heapq.merge(
+            self._gather_to_chunk_from(self._gallery_dir, "gallery"),
+            self._gather_to_chunk_from(self._scraps_dir, "scraps"),
+            key=lambda submission: submission["id"],
+        )
 
     def _gather_to_chunk_from(self, dir, location):
         submissions_by_id = {}
-        for name in os.listdir(dir):
-            path = os.path.join(dir, name)
-            match = FaArchiver.SUBMISSION_RE.search(name)
-            if match:
-                submission_id = match[1]
-                file_type = match[2]
-
-                if submission_id in submissions_by_id:
-                    submission = submissions_by_id[submission_id]
-                else:
-                    submission = {"id": int(submission_id), "location": location}
-                    submissions_by_id[submission_id] = submission
-
-                if file_type == "d":
-                    submission["data"] = path
-                elif file_type == "f":
-                    submission["file"] = path
-                elif file_type == "t":
-                    submission["thumb"] = path
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+
+                name = entry.name
+                if name.endswith(FaArchiver.PART_SUFFIX):
+                    continue
+
+                path = entry.path
+                match = FaArchiver.SUBMISSION_RE.match(name)
+                if match:
+                    submission_id = int(match[1])
+                    file_type = match[2]
+
+                    if submission_id in submissions_by_id:
+                        submission = submissions_by_id[submission_id]
+                    else:
+                        submission = {"id": submission_id, "location": location}
+                        submissions_by_id[submission_id] = submission
+
+                    if file_type == "d":
+                        submission["data"] = path
+                    elif file_type == "f":
+                        submission["file"] = path
+                    elif file_type == "t":
+                        submission["thumb"] = path
+                    else:
+                        raise NotImplemented(file_type)
                 else:
-                    raise NotImplemented(file_type)
-            else:
-                logging.warning("Not an archive file: '{}'".format(path))
-        return list(submissions_by_id.values())
+                    logging.warning("Not an archive file: '%s'", path)
+        return [submissions_by_id[key] for key in sorted(submissions_by_id)]
 
     def _chunk_submissions(self, submissions, chunk_size):
         chunk_base_dir = os.path.join(self._base_dir, "chunk{}".format(chunk_size))
         os.mkdir(chunk_base_dir)
-        offset = 0
+        submissions = iter(submissions)
         index = 0
-        while offset < len(submissions):
-            self._make_chunk(
-                index, submissions[offset : offset + chunk_size], chunk_base_dir
-            )
-            offset += chunk_size
+        while chunk := list(itertools.islice(submissions, chunk_size)):
+            self._make_chunk(index, chunk, chunk_base_dir)
             index += 1
 
     def _make_chunk(self, index, submissions, chunk_base_dir):
@@ -398,40 +743,72 @@ class FaArchiver:
         scraps_dir = os.path.join(chunk_dir, "scraps")
         os.mkdir(gallery_dir)
         os.mkdir(scraps_dir)
+        sources = []
+        targets = []
         for submission in submissions:
             target_dir = (
                 gallery_dir if submission["location"] == "gallery" else scraps_dir
             )
             for key in ["data", "file", "thumb"]:
                 if key in submission:
-                    shutil.copy2(submission[key], target_dir)
+                    source = submission[key]
+                    sources.append(source)
+                    targets.append(os.path.join(target_dir, os.path.basename(source)))
+        with concurrent.futures.ThreadPoolExecutor(FaArchiver.COPY_WORKERS) as pool:
+            for _ in pool.map(FaArchiver._link_or_copy, sources, targets):
+                pass
+
+    # Hardlinking just adds another directory entry for the same file, which
+    # is much cheaper than copying all of its bytes. If that's not possible,
+    # like across filesystems or on ones without hardlinks, copy instead.
+    @staticmethod
+    def _link_or_copy(source, target):
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
 
     # Database access.
 
+    # WAL mode with normal syncing makes commits cheap, since they just append
+    # to the log instead of syncing a rollback journal every time. SQLite
+    # leaves -wal and -shm files next to the database while it's open. A crash
+    # or power loss can lose the last few commits, but it won't corrupt the
+    # database. That's fine, since anything lost just gets collected again or
+    # is skipped because its files are already there. Reads go through a
+    # memory map, SQLite falls back to normal reads on its own if that's not
+    # supported.
     def _open_db(self):
         self._db = sqlite3.connect(self._db_file)
+        self._db.executescript(
+            """
+            pragma journal_mode = wal;
+            pragma synchronous = normal;
+            pragma temp_store = memory;
+            pragma cache_size = -65536;
+            pragma mmap_size = 268435456;
+            """
+        )
 
     def _get_state_bool(self, key):
         value = self._get_state_int(key)
         return value is not None and value != 0
 
     def _get_state_int(self, key):
-        with contextlib.closing(self._db.cursor()) as cur:
-            cur.execute(
-                "select cast(value as integer) from state where key = ?", (key,)
-            )
-            row = cur.fetchone()
-            return row[0] if row else None
+        row = self._db.execute(
+            "select cast(value as integer) from state where key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
 
     def _get_state_string(self, key):
         return FaArchiver.get_state_string(self._db, key)
 
     @staticmethod
     def get_state_string(db, key):
-        with contextlib.closing(db.cursor()) as cur:
-            cur.execute("select cast(value as text) from state where key = ?", (key,))
-            row = cur.fetchone()
-            return row[0] if row else None
+        row = db.execute(
+            "select cast(value as text) from state where key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
 
     def _set_state(self, con, key, value):
         con.execute(
@@ -442,35 +819,48 @@ class FaArchiver:
             (key, value),
         )
 
-    def _insert_archive_element(self, con, element_type, element_id, element_data):
-        con.execute(
+    def _insert_archive_elements(self, con, rows):
+        con.executemany(
             """
-            insert into archive_element(type, element_id, element_data, archived)
+            insert or ignore into archive_element(
+                type, element_id, element_data, archived)
             values (?, ?, ?, 0)
             """,
-            (element_type, element_id, element_data),
+            rows,
         )
 
-    def _get_next_open_archive_element(self):
-        with contextlib.closing(self._db.cursor()) as cur:
-            cur.execute(
-                """
-                select id, type, element_id, element_data from archive_element
-                where not archived order by id limit 1
-                """
-            )
-            return cur.fetchone()
+    def _get_archive_element_ids(self, element_type):
+        cur = self._db.execute(
+            "select element_id from archive_element where type = ?", (element_type,)
+        )
+        return {row[0] for row in cur}
+
+    # Open elements are fetched in batches by id, so that neither a huge
+    # archive has to be held in memory, nor do the archived flags getting
+    # written in the meantime mess with the iteration.
+    def _iter_open_archive_elements(self):
+        last_db_id = 0
+        while rows := self._db.execute(
+            """
+            select id, type, element_id, element_data from archive_element
+            where archived = 0 and id > ? order by id limit ?
+            """,
+            (last_db_id, FaArchiver.OPEN_BATCH_SIZE),
+        ).fetchall():
+            yield from rows
+            last_db_id = rows[-1][0]
 
-    def _close_archive_element(self, db_id):
+    def _close_archive_elements(self, db_ids):
         with self._db as con:
-            con.execute(
-                "update archive_element set archived = 1 where id = ?", (db_id,)
+            con.executemany(
+                "update archive_element set archived = 1 where id = ?",
+                ((db_id,) for db_id in db_ids),
             )
 
     def _count_open_elements(self):
-        with contextlib.closing(self._db.cursor()) as cur:
-            cur.execute("select count(*) from archive_element where not archived")
-            return cur.fetchone()[0]
+        return self._db.execute(
+            "select count(*) from archive_element where archived = 0"
+        ).fetchone()[0]
 
 
 def main_cmd_archive(artist, base_dir):
@@ -596,9 +986,28 @@ def main_gui():
     text = ScrolledText(frm, state="disabled", wrap="word")
     text.grid(column=0, row=6, columnspan=4, padx=PADX, pady=PADY, sticky="nsew")
 
+    # Log messages wake up the GUI thread through a virtual event instead of
+    # it polling the queue. The event is generated after the handler's lock
+    # is released, since from other threads it has to wait for the GUI thread,
+    # which might be trying to log something itself at the same time. While an
+    # event is already pending, there's no point in generating another one, the
+    # GUI thread will pick up every message in the queue when it gets to it.
+    update_log_pending = threading.Event()
+
+    class EventQueueHandler(QueueHandler):
+        def handle(self, record):
+            handled = super().handle(record)
+            if handled and not update_log_pending.is_set():
+                update_log_pending.set()
+                root.event_generate("<<LogMessage>>", when="tail")
+            return handled
+
     queue = SimpleQueue()
     formatter = logging.Formatter("%(levelname)s: %(message)s\n")
-    logging.getLogger().addHandler(QueueHandler(queue))
+    # Long runs log a lot, old lines get dropped so the text widget doesn't
+    # keep growing and getting slower.
+    max_log_lines = 5000
+    logging.getLogger().addHandler(EventQueueHandler(queue))
     logging.info(
         "Fill in the fields above and press the Download Archive button to start."
     )
@@ -625,6 +1034,7 @@ def main_gui():
     archiver_instance = None
 
     def update_log():
+        update_log_pending.clear()
         have_message = False
         while True:
             try:
@@ -639,6 +1049,13 @@ def main_gui():
             except Empty:
                 break
         if have_message:
+            excess_lines = int(text.index("end-1c").split(".")[0]) - max_log_lines
+            if excess_lines > 0:
+                text["state"] = "normal"
+                try:
+                    text.delete("1.0", "{}.0".format(excess_lines + 1))
+                finally:
+                    text["state"] = "disabled"
             text.see("end")
 
         nonlocal archiver_finished
@@ -653,8 +1070,7 @@ def main_gui():
                 root.destroy()
                 sys.exit(0)
 
-        root.after(100, update_log)
-
+    root.bind("<<LogMessage>>", lambda event: update_log())
     update_log()
 
     def make_archiver():